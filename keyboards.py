@@ -10,8 +10,8 @@ PAID_CB     = "paid"
 RECEIVED_CB = "received"
 
 def moderation_keyboard(chat_id: int, status_msg_id: int):
-    inv = store.get(status_msg_id) or {"status": WAIT}
-    st = inv.get("status", WAIT)
+    inv = store.get(status_msg_id)
+    st = inv.status if inv else WAIT
     rows: list[list[InlineKeyboardButton]] = []
 
     if st == WAIT:
@@ -13,6 +13,7 @@ main_web_v2.py — модульная версия с кнопками моде
   store.py         — простое хранилище в памяти (store, store_invoice)
   keyboards.py     — клавиатуры (moderation_keyboard, APPROVE_CB/REJECT_CB)
   moderation.py    — обработчик нажатий (handle_moderation)
+  processor_batch.py — пакетное согласование через OpenAI Batch API (/batch)
 """
 
 from __future__ import annotations
@@ -25,14 +26,17 @@ from telegram.ext import (
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    CallbackContext,
     ContextTypes,
     filters,
 )
 
 # наши модули
-from store import store_invoice
+from store import store, store_invoice, APPROVED, WAIT
 from keyboards import moderation_keyboard
-from moderation import handle_moderation
+from moderation import handle_moderation, refresh_status_card, ADMIN_USER_IDS
+from processor import warmup
+from processor_batch import resume_pending_batches, submit_batch
 
 # ------------------------- Логирование -------------------------
 logging.basicConfig(
@@ -90,6 +94,71 @@ async def cmd_whoami(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     uid = user.id if user else None
     await update.effective_message.reply_text(f"Ваш user_id: {uid}")
 
+async def cmd_batch(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/batch <message_id> ... — согласовать счета пакетом: QR придут через
+    OpenAI Batch API (вдвое дешевле, но до 24 ч)."""
+    chat = update.effective_chat
+    msg = update.effective_message
+    user = update.effective_user
+    if not chat or not msg:
+        return
+    if ADMIN_USER_IDS and (not user or user.id not in ADMIN_USER_IDS):
+        await msg.reply_text("⛔ У вас нет прав на эту операцию.")
+        return
+
+    args = list(dict.fromkeys(context.args or []))   # /batch 5 5 — один счёт
+    if not args:
+        await msg.reply_text("Использование: /batch <message_id> [<message_id> ...]")
+        return
+
+    # в пакет — только ждущие согласования счета с исходным файлом; результат
+    # и карточка — в чате исходного сообщения, а не там, где набрали команду
+    ids: list[int] = []
+    skipped: list[str] = []
+    for a in args:
+        inv = store.get(int(a)) if a.isdigit() else None
+        if inv is None or inv.src is None:
+            skipped.append(f"{a} — счёт или его файл не найден")
+        elif inv.status != WAIT:
+            skipped.append(f"{a} — уже не ждёт согласования")
+        else:
+            ids.append(int(a))
+
+    # сразу убираем «Согласовать» с карточек, чтобы не запустить второй разбор онлайн
+    for mid in ids:
+        store.set_status(mid, APPROVED)
+        await _refresh_card(context, mid)
+
+    batch_id = None
+    error = ""
+    if ids:
+        try:
+            batch_id = await submit_batch(context, ids)
+        except Exception as e:
+            log.exception("Batch submit failed for %s", ids)
+            error = str(e)
+            for mid in ids:
+                store.set_status(mid, WAIT)
+                await _refresh_card(context, mid)
+
+    lines = []
+    if error:
+        lines.append(f"⚠️ Не удалось отправить пакет: {error}\nСчета снова ждут согласования.")
+    elif batch_id:
+        lines.append(f"📦 Счета ушли на пакетный разбор ({batch_id}), QR придут по готовности.")
+    elif ids:
+        lines.append("✅ Пакет не понадобился: счета обработаны сразу.")
+    if skipped:
+        lines.append("Пропущены:\n" + "\n".join(skipped))
+    await msg.reply_text("\n\n".join(lines))
+
+async def _refresh_card(context: ContextTypes.DEFAULT_TYPE, status_msg_id: int) -> None:
+    src = store.get(status_msg_id).src
+    try:
+        await refresh_status_card(context, src.chat_id, status_msg_id)
+    except Exception as e:
+        log.warning("Card refresh failed for status_msg_id=%s: %s", status_msg_id, e)
+
 # ------------------------- Утилиты -------------------------
 def detect_kind_from_message(msg) -> str:
     if getattr(msg, "photo", None):
@@ -174,6 +243,12 @@ async def handle_file_channel(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def _post_init(app):
     me = await app.bot.get_me()
     log.info("Bot getMe: username=@%s id=%s", me.username, me.id)
+    # openai/segno и первый QR — до первого нажатия «Согласовать»
+    await warmup()
+    # батчи, не завершённые до перезапуска; опросу из контекста нужен только bot
+    resumed = await resume_pending_batches(CallbackContext(app))
+    if resumed:
+        log.info("Resumed %d pending GPT batches", resumed)
 
 def main() -> None:
     app = ApplicationBuilder().token(TOKEN).post_init(_post_init).build()
@@ -182,6 +257,7 @@ def main() -> None:
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("debug", cmd_debug))
     app.add_handler(CommandHandler("whoami", cmd_whoami))
+    app.add_handler(CommandHandler("batch", cmd_batch))
 
     # Кнопки модерации (коллбэк)
     app.add_handler(CallbackQueryHandler(handle_moderation))
@@ -17,7 +17,7 @@ from flask import Flask, request, jsonify
 from urllib.parse import urlencode
 import urllib.request
 
-from processor import gpt_process, build_st00012, make_qr_png
+from processor import gpt_process, build_st00012, make_qr_png, warmup_sync
 
 logging.basicConfig(
     level=os.getenv("LOG_LEVEL", "INFO"),
@@ -289,6 +289,7 @@ def webhook():
 
 def main():
     port = int(os.getenv("PORT","10000"))
+    warmup_sync()
     app.run(host="0.0.0.0", port=port)
 
 if __name__ == "__main__":
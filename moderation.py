@@ -5,7 +5,7 @@ from typing import Dict, Tuple
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from store import store, WAIT, APPROVED, REJECTED, PAID, RECEIVED
+from store import store, Invoice, Status, WAIT, APPROVED, REJECTED, PAID, RECEIVED
 from keyboards import (
     moderation_keyboard,
     APPROVE_CB, REJECT_CB, REASON_CB, PAID_CB, RECEIVED_CB,
@@ -21,7 +21,7 @@ ADMIN_USER_IDS = {
 WAITING_REASON: Dict[int, Tuple[int, int]] = {}
 
 
-def _human_status(code: str) -> str:
+def _human_status(code: Status) -> str:
     return {
         WAIT: "Ожидает согласования",
         APPROVED: "Согласован",
@@ -31,15 +31,26 @@ def _human_status(code: str) -> str:
     }.get(code, code)
 
 
-def build_status_text(inv: dict) -> str:
-    status = _human_status(inv.get("status", WAIT))
-    reason = inv.get("reason") or ""
+def build_status_text(inv: Invoice) -> str:
+    status = _human_status(inv.status)
+    reason = inv.reason
     lines = ["📄 Счёт", f"Статус: {status}"]
-    if inv.get("status") == REJECTED and reason:
+    if inv.status == REJECTED and reason:
         lines.append(f"Причина: {reason}")
     return "\n".join(lines)
 
 
+async def refresh_status_card(context: ContextTypes.DEFAULT_TYPE, chat_id: int, status_msg_id: int) -> None:
+    """Перерисовывает карточку счёта (текст и кнопки) по текущему состоянию в store."""
+    inv = store.get(status_msg_id) or Invoice()
+    await context.bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=status_msg_id,
+        text=build_status_text(inv),
+        reply_markup=moderation_keyboard(chat_id, status_msg_id),
+    )
+
+
 async def handle_moderation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query
     if not q:
@@ -57,7 +68,7 @@ async def handle_moderation(update: Update, context: ContextTypes.DEFAULT_TYPE)
     data = (q.data or "").split(":")
     action = data[0] if data else ""
 
-    inv = store.get(status_msg_id) or {"status": WAIT, "reason": ""}
+    inv = store.get(status_msg_id) or Invoice()
 
     if action == APPROVE_CB:
         store.set_status(status_msg_id, APPROVED)
@@ -103,7 +114,7 @@ async def handle_reason_message(update: Update, context: ContextTypes.DEFAULT_TY
     reason_text = (update.effective_message.text or "").strip()
     store.set_reason(status_msg_id, reason_text)
 
-    inv = store.get(status_msg_id) or {}
+    inv = store.get(status_msg_id) or Invoice()
     WAITING_REASON.pop(user.id, None)
 
     # Обновляем карточку
@@ -3,9 +3,9 @@
 # - Жёсткая очистка текстовых полей (запрещаем '|' и '='), приведение Sum к копейкам.
 # - OCR фикс цифр (O→0, I/l→1 и т.д.), валидация и понятные русские причины отказа.
 # - DOCX с картинками: извлекаем embedded-изображения и отправляем их в GPT.
-# - PDF-сканы: рендер страниц в PNG (360 DPI).
+# - PDF-сканы: рендер страниц в JPEG (220 DPI для A4 и крупнее, 360 — для мелких страниц).
 # - Excel: авто-детект xlsx/xls/csv.
-# - Автоповтор на более сильной модели при провале валидации (RETRY_MODEL).
+# - Автоповтор на RETRY_MODEL при провале валидации: в диалог добавляется прошлый ответ и причина отказа.
 
 from __future__ import annotations
 import asyncio
@@ -15,15 +15,27 @@ import re
 import json
 import csv
 import base64
+import functools
+import hashlib
 import logging
-from typing import Tuple, Optional, List
+import random
+import threading
+import weakref
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Tuple, Optional, List, Union
 
-from openai import OpenAI
-import qrcode  # pillow обязателен
+try:
+    import orjson  # быстрый JSON (Rust); без него — стандартный json
+except ImportError:
+    orjson = None
 
-from telegram.ext import ContextTypes
 from store import store
 
+# openai, segno и telegram.ext импортируются по месту: холодный старт не платит за них
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from telegram.ext import ContextTypes
+
 log = logging.getLogger("processor")
 
 NBSP = "\u00A0"
@@ -55,13 +67,79 @@ EXCEL_EXTENSIONS = (
 GPT_MODEL = os.getenv("GPT_INVOICE_MODEL", "gpt-4o-mini")
 RETRY_MODEL = os.getenv("GPT_RETRY_MODEL", "gpt-4o")
 MAX_RETRY_ON_FAIL = int(os.getenv("GPT_MAX_RETRY_ON_FAIL", "1"))
+GPT_CONCURRENCY = int(os.getenv("GPT_CONCURRENCY", "8"))  # одновременных запросов к OpenAI
+TG_CONCURRENCY = int(os.getenv("TG_CONCURRENCY", "8"))    # одновременных счетов в пакетном согласовании
+GPT_API_ATTEMPTS = int(os.getenv("GPT_API_ATTEMPTS", "3"))  # попыток при 429/таймауте
+# микробатчинг: до N счетов, пришедших в окне, — одним запросом (0/1 — выключен)
+GPT_MICROBATCH = int(os.getenv("GPT_MICROBATCH", "0"))
+GPT_MICROBATCH_WINDOW = float(os.getenv("GPT_MICROBATCH_WINDOW_MS", "200")) / 1000
+
+# -------- кэш --------
+# версия промпта входит в ключ кэша: поменяли SYSTEM_PROMPT — поднимите версию
+PROMPT_VERSION = "v3.0"
+# в кэше реквизиты получателей — по умолчанию выключен, каталог создаётся с правами 0700
+CACHE_DIR = os.getenv("INVOICE_CACHE_DIR", "")  # пусто — без кэша
+CACHE_TTL = int(os.getenv("INVOICE_CACHE_TTL", str(7 * 24 * 3600)))
+
+# -------- QR --------
+QR_TARGET_PX = int(os.getenv("QR_TARGET_PX", "512"))  # сторона картинки, пиксели
+QR_MIN_SCALE = 4                                      # меньше — банковские приложения читают хуже
 
 # -------- utils --------
+_NON_DIGIT_RE   = re.compile(r"\D+")
+_WS_RE          = re.compile(r"\s+")
+_MONEY_STRIP_RE = re.compile(r"[^\d,\.]")
+
+_CACHE = None  # None — ещё не открывали, False — кэш недоступен
+
+def _disk_cache():
+    """diskcache.Cache в CACHE_DIR или None (кэш выключен / нет diskcache)."""
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = False
+        if CACHE_DIR:
+            try:
+                import diskcache
+                # diskcache создаёт каталог 0755 — заводим сами и закрываем от других пользователей
+                os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+                os.chmod(CACHE_DIR, 0o700)
+                _CACHE = diskcache.Cache(CACHE_DIR)
+            except Exception as e:
+                log.warning("Disk cache disabled: %s", e)
+    return _CACHE or None
+
+# частые плательщики и заглушка повторяются — держим последние PNG в памяти
+@functools.lru_cache(maxsize=512)
 def _qr_png_bytes(payload: str) -> bytes:
-    img = qrcode.make(payload)
+    cache = _disk_cache()
+    key = "qr:" + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    if cache is not None:
+        png = cache.get(key)
+        if png is not None:
+            return png
+
+    import segno  # QR → PNG без Pillow
+    # ST00012 = UTF-8; без явной кодировки segno для кириллицы выбрал бы Shift_JIS.
+    # Режим byte задаём сразу — segno не перебирает numeric/alphanumeric/kanji.
+    qr = segno.make_qr(payload, error="m", mode="byte", encoding="utf-8")
+    # модуль подбираем под ~QR_TARGET_PX: крупнее — лишние байты на загрузку в Telegram
+    side = qr.symbol_size(scale=1, border=2)[0]
+    scale = max(QR_MIN_SCALE, QR_TARGET_PX // side)
     buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    return buf.getvalue()
+    qr.save(buf, kind="png", scale=scale, border=2)
+    png = buf.getvalue()
+    log.info("QR rendered: version %s, %dpx, %d bytes", qr.version, side * scale, len(png))
+    if cache is not None:
+        cache.set(key, png, expire=CACHE_TTL)
+    return png
+
+def _json_loads(s: str):
+    return orjson.loads(s) if orjson is not None else json.loads(s)
+
+def _json_dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
 
 def _to_data_uri(b: bytes, mime: str) -> str:
     return f"data:{mime};base64,{base64.b64encode(b).decode('ascii')}"
@@ -69,21 +147,52 @@ def _to_data_uri(b: bytes, mime: str) -> str:
 def _guess_mime_for_photo() -> str:
     return "image/jpeg"
 
+# 1568 — граница high-detail тайлов GPT-4o: крупнее не точнее, только дороже
+PHOTO_MAX_SIDE = 1568
+_EXIF_ORIENTATION = 0x0112
+
+def _shrink_photo(b: bytes, max_side: int = PHOTO_MAX_SIDE) -> bytes:
+    """Фото для GPT: уменьшаем до max_side по длинной стороне и пережимаем в JPEG q=85.
+    Если Pillow не справился (например, HEIC без плагина) — отдаём исходник."""
+    try:
+        from PIL import Image, ImageOps
+        im = Image.open(io.BytesIO(b))  # читает только заголовок
+        # уже небольшой JPEG без поворота по EXIF — пересжатие ничего не даст
+        if im.format == "JPEG" and max(im.size) <= max_side and im.getexif().get(_EXIF_ORIENTATION, 1) == 1:
+            return b
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((max_side, max_side))
+        out = io.BytesIO()
+        im.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+        return out.getvalue()
+    except Exception as e:
+        log.warning("Photo shrink failed, sending original: %s", e)
+        return b
+
 def _digits_only(s: str) -> str:
-    return re.sub(r"\D+", "", s or "")
-
-def _ocr_digit_fix(s: str) -> str:
-    """Частые OCR-замены в числовых полях: O→0, I/l→1, B→8, S→5, Z→2."""
-    if not isinstance(s, str):
-        return s
-    table = str.maketrans({
-        "O": "0", "o": "0",
-        "I": "1", "l": "1", "í": "1",
-        "B": "8",
-        "S": "5",
-        "Z": "2"
-    })
-    return s.translate(table)
+    return _NON_DIGIT_RE.sub("", s or "")
+
+class _DigitsOnlyTable(dict):
+    """Таблица для str.translate: частые OCR-замены в числовых полях
+    (O→0, I/l→1, B→8, S→5, Z→2), цифры других письменностей → ASCII,
+    остальные не-цифры удаляются — за один проход."""
+
+    def __missing__(self, code: int) -> Optional[int]:
+        ch = chr(code)
+        v = ord("0") + int(ch) if ch.isdecimal() else None
+        self[code] = v
+        return v
+
+_DIGITS_ONLY_TABLE = _DigitsOnlyTable(str.maketrans({
+    "O": "0", "o": "0",
+    "I": "1", "l": "1", "í": "1",
+    "B": "8",
+    "S": "5",
+    "Z": "2"
+}))
+
+# текстовые поля: NBSP → пробел, «ёлочки» → ", запрещённые в ST00012 '|' и '=' → пробел
+_TEXT_NORMALIZE_TABLE = str.maketrans({NBSP: " ", "«": '"', "»": '"', "|": " ", "=": " "})
 
 def _sanitize_fields(fields: dict) -> dict:
     f = dict(fields or {})
@@ -91,17 +200,11 @@ def _sanitize_fields(fields: dict) -> dict:
     # числовые поля — OCR фиксы → только цифры
     for k in ["PersonalAcc", "CorrespAcc", "BIC", "Sum", "PayeeINN", "KPP"]:
         if k in f and isinstance(f[k], str):
-            v = _ocr_digit_fix(f[k])
-            v = _digits_only(v)
-            f[k] = v
+            f[k] = f[k].translate(_DIGITS_ONLY_TABLE)
 
     # текстовые поля — запрещаем | и =, схлопываем пробелы
     def clean_text(s: str) -> str:
-        s = s.replace(NBSP, " ")
-        s = s.replace("«", '"').replace("»", '"')
-        s = s.replace("|", " ").replace("=", " ")
-        s = re.sub(r"\s+", " ", s).strip()
-        return s
+        return _WS_RE.sub(" ", s.translate(_TEXT_NORMALIZE_TABLE)).strip()
 
     if "Purpose" in f and isinstance(f["Purpose"], str):
         f["Purpose"] = clean_text(f["Purpose"])
@@ -111,7 +214,7 @@ def _sanitize_fields(fields: dict) -> dict:
 
     # Sum — финально к копейкам, если прилетело в рублях
     if f.get("Sum") and not f["Sum"].isdigit():
-        rub = re.sub(r"[^\d,\.]", "", f["Sum"]).replace(",", ".")
+        rub = _MONEY_STRIP_RE.sub("", f["Sum"]).replace(",", ".")
         try:
             f["Sum"] = str(int(round(float(rub) * 100)))
         except Exception:
@@ -160,13 +263,16 @@ def _fields_preview(fields: dict) -> str:
     return "\n".join(show)
 
 # -------- сигнатуры/помощники --------
-def _is_pdf(b: bytes) -> bool:
+# файл из Telegram приходит bytearray и дальше не копируется в bytes
+BytesLike = Union[bytes, bytearray]
+
+def _is_pdf(b: BytesLike) -> bool:
     return b[:4] == b"%PDF"
 
-def _is_xlsx_zip(b: bytes) -> bool:
+def _is_xlsx_zip(b: BytesLike) -> bool:
     return b[:4] == b"PK\x03\x04"
 
-def _is_xls_ole(b: bytes) -> bool:
+def _is_xls_ole(b: BytesLike) -> bool:
     return b[:8] == b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1"
 
 
@@ -188,17 +294,23 @@ def _detect_file_type(file_name: str, file_bytes: bytes) -> str:
     return "document"
 
 
-def _run_coroutine_sync(coro):
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        return asyncio.run(coro)
+_SYNC_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_SYNC_LOOP_LOCK = threading.Lock()
 
-    new_loop = asyncio.new_event_loop()
-    try:
-        return new_loop.run_until_complete(coro)
-    finally:
-        new_loop.close()
+def _sync_loop() -> asyncio.AbstractEventLoop:
+    """Один долгоживущий цикл в фоновом потоке для синхронных вызовов (Flask):
+    клиент OpenAI, семафор, single-flight и микробатчер живут между запросами,
+    а не создаются (и не текут) на каждый запрос."""
+    global _SYNC_LOOP
+    with _SYNC_LOOP_LOCK:
+        if _SYNC_LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="processor-loop", daemon=True).start()
+            _SYNC_LOOP = loop
+    return _SYNC_LOOP
+
+def _run_coroutine_sync(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _sync_loop()).result()
 
 # -------- локальные извлечения --------
 import io as _io
@@ -207,24 +319,78 @@ INV_NUM_RE  = re.compile(r"(?:Сч[её]т(?:\s*на\s*оплату)?\s*№\s*([
 INV_DATE_RE = re.compile(r"от\s*([0-9]{1,2}[.\s][0-9]{1,2}[.\s][0-9]{2,4}|[0-9]{1,2}\s+[А-Яа-яЁёA-Za-z]+?\s+\d{4})")
 VAT_PCT_RE  = re.compile(r"(?:НДС|VAT)\s*([0-9]{1,2})\s*%")
 VAT_SUM_RE  = re.compile(r"(?:НДС[:\s]|VAT[:\s]).{0,30}?([0-9\s\u00A0]+(?:[.,][0-9]{1,2})?)", re.IGNORECASE)
-TOTAL_RE    = re.compile(r"(?:Всего\s*к\s*оплате|Итого|Total).{0,30}?([0-9\s\u00A0]+(?:[.,][0-9]{1,2})?)", re.IGNORECASE)
+TOTAL_RE    = re.compile(r"(?:Всего\s*к\s*оплате|Итого|\bTotal\b).{0,30}?([0-9\s\u00A0]+(?:[.,][0-9]{1,2})?)", re.IGNORECASE)
+# для разбора без GPT сумма берётся только из «(Всего) к оплате»; «Итого» может
+# стоять до скидки — если итоги расходятся с суммой к оплате, решает GPT
+_MONEY_GROUP = r"([0-9](?:[0-9 \u00A0]*[0-9])?(?:[.,][0-9]{1,2})?)"
+PAYABLE_RE  = re.compile(r"(?<!\w)(?:Всего\s+)?к\s+оплате\b\D{0,30}?" + _MONEY_GROUP, re.IGNORECASE)
+SUBTOTAL_RE = re.compile(r"(?:Итого|\bTotal\b)\D{0,30}?" + _MONEY_GROUP, re.IGNORECASE)
+
+# реквизиты получателя — для разбора цифровых PDF/DOCX/Excel без GPT
+ACC20_RE    = re.compile(r"(?<!\d)\d{20}(?!\d)")
+BIC_RE      = re.compile(r"(?<!\d)04\d{7}(?!\d)")
+INN_RE      = re.compile(r"ИНН\D{0,3}(\d{12}|\d{10})(?!\d)")
+KPP_RE      = re.compile(r"КПП\D{0,3}(\d{9})(?!\d)")
+PAYEE_RE    = re.compile(
+    r"(?:Получатель|Поставщик(?:\s*\(Исполнитель\))?|Исполнитель|Продавец)\s*:?\s*"
+    r"((?:ООО|АО|ПАО|ЗАО|ОАО|НКО|ИП)\s[^,\n]+)"
+)
+BANK_LINE_RE  = re.compile(r"^[^\n]*банк[^\n]*$", re.IGNORECASE | re.MULTILINE)
+BANK_LABEL_RE = re.compile(r"банк\s+(?:получателя|плательщика)", re.IGNORECASE)
+BANK_TAIL_RE  = re.compile(r"\b(?:БИК|Сч\.|к/с|р/с)|\d{9,}", re.IGNORECASE)
+NO_VAT_RE   = re.compile(r"без\s+(?:налога\s*\(?\s*)?НДС", re.IGNORECASE)
+# метки сторон: реквизиты берём только из блоков получателя, блоки покупателя/плательщика
+# («Банк плательщика», «Грузополучатель» и т.п.) вырезаем до следующей метки
+PARTY_RE    = re.compile(
+    r"\b(?:(?P<payee>получател[ья]|поставщик|исполнитель|продавец|грузоотправитель)"
+    r"|покупател[ья]|плательщик[а]?|заказчик|грузополучатель)\b",
+    re.IGNORECASE,
+)
 
-def _pdf_to_text(file_bytes: bytes) -> str:
+def _pdf_page_texts(file_bytes: bytes, max_pages: int):
+    """Текст страниц по одной: PyMuPDF (нативный, в разы быстрее), иначе PyPDF2."""
     try:
+        import fitz  # PyMuPDF
+        doc = fitz.open(stream=file_bytes, filetype="pdf")
+    except Exception as e:
+        log.warning("PyMuPDF text extract unavailable, using PyPDF2: %s", e)
         from PyPDF2 import PdfReader
         r = PdfReader(io.BytesIO(file_bytes))
-        chunks = []
-        for p in r.pages:
+        for i in range(min(len(r.pages), max_pages)):
             try:
-                chunks.append((p.extract_text() or "").replace(NBSP, " "))
+                yield r.pages[i].extract_text() or ""
             except Exception:
                 pass
-        return "\n".join(chunks)
+        return
+    try:
+        for i in range(min(len(doc), max_pages)):
+            try:
+                yield doc.load_page(i).get_text()
+            except Exception:
+                pass
+    finally:
+        doc.close()
+
+def _pdf_to_text(file_bytes: bytes, max_pages: int = 5) -> str:
+    chunks = []
+    has_acc = has_total = False
+    try:
+        for txt in _pdf_page_texts(file_bytes, max_pages):
+            txt = txt.replace(NBSP, " ")
+            chunks.append(txt)
+            # счёт и итог уже есть — остальные страницы (договор, акты) не нужны;
+            # ищем только в новой странице, без повторной склейки всего текста
+            has_acc = has_acc or ACC20_RE.search(txt) is not None
+            has_total = has_total or TOTAL_RE.search(txt) is not None
+            if has_acc and has_total:
+                break
     except Exception as e:
         log.warning("PDF extract failed: %s", e)
-        return ""
+    return "\n".join(chunks)
 
-def _pdf_to_images(file_bytes: bytes, max_pages: int = 3, dpi: int = 360) -> List[bytes]:
+def _pdf_to_images(file_bytes: bytes, max_pages: int = 3, dpi: Optional[int] = None) -> List[bytes]:
+    """Страницы скана в JPEG. Без явного dpi: мелкие страницы (чеки, A5) — 360,
+    A4 и крупнее — 220 DPI, для OCR этого достаточно, а картинка в разы легче."""
     try:
         import fitz  # PyMuPDF
     except Exception as e:
@@ -238,12 +404,13 @@ def _pdf_to_images(file_bytes: bytes, max_pages: int = 3, dpi: int = 360) -> Lis
     images = []
     try:
         pages = min(len(doc), max_pages)
-        zoom = dpi / 72.0
-        mat = fitz.Matrix(zoom, zoom)
         for i in range(pages):
             page = doc.load_page(i)
-            pix = page.get_pixmap(matrix=mat, alpha=False)
-            images.append(pix.tobytes("png"))
+            # единицы PyMuPDF — 1/72 дюйма: A4 = 595x842
+            page_dpi = dpi or (360 if max(page.rect.width, page.rect.height) < 700 else 220)
+            zoom = page_dpi / 72.0
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            images.append(pix.tobytes("jpeg", jpg_quality=85))
     except Exception as e:
         log.warning("PDF render to images failed: %s", e)
     finally:
@@ -270,14 +437,18 @@ def _xls_to_text(file_bytes: bytes) -> str:
 def _xlsx_to_text(file_bytes: bytes) -> str:
     try:
         from openpyxl import load_workbook
-        wb = load_workbook(io.BytesIO(file_bytes), data_only=True)
-        out = []
-        for ws in wb.worksheets:
-            for row in ws.iter_rows(values_only=True):
-                vals = [str(v) if v is not None else "" for v in row]
-                if any(vals):
-                    out.append(" | ".join(vals))
-        return "\n".join(out)
+        # read_only — строки читаются потоком из zip, без модели всей книги в памяти
+        wb = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+        try:
+            out = []
+            for ws in wb.worksheets:
+                for row in ws.iter_rows(values_only=True):
+                    vals = ["" if v is None else str(v) for v in row]
+                    if any(vals):
+                        out.append(" | ".join(vals))
+            return "\n".join(out)
+        finally:
+            wb.close()  # в read_only книга держит zip открытым
     except Exception as e:
         log.warning("XLSX extract failed: %s", e)
         return ""
@@ -338,11 +509,13 @@ def _docx_images(file_bytes: bytes, max_images: int = 5) -> List[bytes]:
         log.warning("DOCX images extract failed: %s", e)
     return imgs
 
+# сумма за один проход: пробелы и NBSP убираем, запятую → точка
+_MONEY_TABLE = str.maketrans({NBSP: None, " ": None, ",": "."})
+
 def _normalize_money(s: str) -> Optional[float]:
     if not s:
         return None
-    s = s.replace(NBSP, " ").replace(" ", "")
-    s = s.replace(",", ".")
+    s = s.translate(_MONEY_TABLE)
     try:
         return float(s)
     except Exception:
@@ -385,27 +558,157 @@ def _pre_hint(text: str) -> dict:
         "total": total,
     }
 
+# контрольный ключ счёта по БИК (3 цифры БИК/РКЦ + 20 цифр счёта, веса 7-1-3)
+_ACC_KEY_WEIGHTS = (7, 1, 3) * 8
+
+def _acc_key_ok(bic: str, acc: str, corresp: bool = False) -> bool:
+    prefix = "0" + bic[4:6] if corresp else bic[-3:]
+    return sum(int(d) * w for d, w in zip(prefix + acc, _ACC_KEY_WEIGHTS)) % 10 == 0
+
+def _find_bank_name(t: str) -> str:
+    for m in BANK_LINE_RE.finditer(t):
+        line = BANK_LABEL_RE.sub("", m.group(0))
+        line = BANK_TAIL_RE.split(line, 1)[0].strip(" ,.:;")
+        if "банк" in line.lower():
+            return line
+    return ""
+
+_LOCAL_TEXT_TABLE = str.maketrans({NBSP: " ", "\r": "\n"})
+
+def _payable_total(t: str) -> Optional[float]:
+    """Сумма «(Всего) к оплате», если она однозначна и все «Итого/Total» с ней совпадают."""
+    payable = {_normalize_money(m.group(1)) for m in PAYABLE_RE.finditer(t)}
+    if len(payable) != 1:
+        return None
+    total = payable.pop()
+    if total is None:
+        return None
+    for m in SUBTOTAL_RE.finditer(t):
+        if _normalize_money(m.group(1)) != total:
+            return None
+    return total
+
+def _payee_text(t: str) -> str:
+    """Текст без блоков покупателя/плательщика: от их метки до следующей метки стороны."""
+    parts = []
+    pos = 0
+    other = False
+    for m in PARTY_RE.finditer(t):
+        if not other:
+            parts.append(t[pos:m.start()])
+        other = m.group("payee") is None
+        pos = m.start()
+    if not other:
+        parts.append(t[pos:])
+    return "".join(parts)
+
+def _local_extract_fields(text: str, prehint: dict) -> dict:
+    """Реквизиты ST00012 регулярками из текста документа.
+
+    Реквизиты ищутся только вне блоков покупателя/плательщика (_payee_text).
+    Возвращает поля только если найдено всё обязательное, счета сходятся
+    с БИК по контрольному ключу, а р/с и ИНН однозначны, иначе {} — тогда работает GPT."""
+    t = (text or "").translate(_LOCAL_TEXT_TABLE)
+    pt = _payee_text(t)
+    m = BIC_RE.search(pt)
+    if not m:
+        return {}
+    bic = m.group(0)
+
+    personal: set = set()
+    corresp = ""
+    for acc in ACC20_RE.findall(pt):
+        if acc.startswith("301"):
+            if not corresp and _acc_key_ok(bic, acc, corresp=True):
+                corresp = acc
+        elif _acc_key_ok(bic, acc):
+            personal.add(acc)
+    # два валидных р/с — неясно, какой получателя
+    if len(personal) != 1 or not corresp:
+        return {}
+    inns = set(INN_RE.findall(pt))
+    if len(inns) > 1:
+        return {}
+
+    m = PAYEE_RE.search(pt)
+    name = m.group(1).strip() if m else ""
+    bank = _find_bank_name(pt)
+    total = _payable_total(t)
+    inv_num = prehint.get("invoice_number")
+    if not (name and bank and total and total > 0 and inv_num):
+        return {}
+
+    # назначение — как просим у GPT: «Оплата по счёту №… от …, НДС X% — Y ₽ / без НДС»
+    vat_pct = prehint.get("vat_percent")
+    if vat_pct:
+        # сумма НДС из подсказки ненадёжна (VAT_SUM_RE может поймать ставку) —
+        # считаем от итога и требуем, чтобы такая сумма была в документе
+        vat_sum = f"{total * vat_pct / (100 + vat_pct):.2f}"
+        compact = t.replace(" ", "")
+        if vat_sum not in compact and vat_sum.replace(".", ",") not in compact:
+            return {}
+        vat = f"НДС {vat_pct}% — {vat_sum.replace('.', ',')} ₽"
+    elif NO_VAT_RE.search(t):
+        vat = "без НДС"
+    else:
+        return {}
+    purpose = f"Оплата по счёту №{inv_num}"
+    if prehint.get("invoice_date"):
+        purpose += f" от {prehint['invoice_date']}"
+
+    fields = {
+        "Name": name,
+        "PersonalAcc": personal.pop(),
+        "BankName": bank,
+        "BIC": bic,
+        "CorrespAcc": corresp,
+        "Sum": str(int(round(total * 100))),
+        "Purpose": f"{purpose}, {vat}",
+    }
+    if inns:
+        fields["PayeeINN"] = inns.pop()
+    m = KPP_RE.search(pt)
+    if m:
+        fields["KPP"] = m.group(1)
+    return fields
+
 # -------- валидация/подписи --------
+_ST_FIELD_RE = re.compile(r"\|([A-Za-z]+)=([^|]*)")
+
+# быстрый путь: один проход regex по заведомо чистой строке (её и собирает
+# _build_st00012_from_fields). Каждое обязательное поле — последнее вхождение ключа
+# (как в dict(findall)), значения в каноническом виде. Не совпало — разбираем
+# подробно ниже, чтобы вернуть точную причину.
+_ST_CLEAN_VALUES = {
+    "Name": r"[^|]*[^|\s][^|]*",
+    "PersonalAcc": r"[0-9]{20}",
+    "BankName": r"[^|]*[^|\s][^|]*",
+    "BIC": r"[0-9]{9}",
+    "CorrespAcc": r"[0-9]{20}",
+    "Sum": r"0*[1-9][0-9]*",
+    "Purpose": r"[^|]*[^|\s][^|]*",
+}
+_ST_VALID_RE = re.compile(
+    r"ST00012(?=\|)"
+    + "".join(rf"(?=.*\|{k}={v}(?=\||$)(?!.*\|{k}=))" for k, v in _ST_CLEAN_VALUES.items()),
+    re.DOTALL,
+)
+
 def _validate_st00012(st: str) -> Optional[str]:
     if not st or not st.startswith("ST00012|"):
         return "payload is not ST00012"
-    fields = {}
-    try:
-        for p in st.split("|")[1:]:
-            if "=" in p:
-                k, v = p.split("=", 1)
-                fields[k] = v
-    except Exception:
-        return "failed to parse key=value pairs"
+    if _ST_VALID_RE.match(st):
+        return None
+    fields = dict(_ST_FIELD_RE.findall(st))
 
     missing = [k for k in ST00012_REQUIRED if k not in fields or not str(fields[k]).strip()]
     if missing:
         return "missing:" + ",".join(missing)
 
-    bic = re.sub(r"\D+", "", fields["BIC"])
-    pa  = re.sub(r"\D+", "", fields["PersonalAcc"])
-    ca  = re.sub(r"\D+", "", fields["CorrespAcc"])
-    s   = re.sub(r"\D+", "", fields["Sum"])
+    bic = _NON_DIGIT_RE.sub("", fields["BIC"])
+    pa  = _NON_DIGIT_RE.sub("", fields["PersonalAcc"])
+    ca  = _NON_DIGIT_RE.sub("", fields["CorrespAcc"])
+    s   = _NON_DIGIT_RE.sub("", fields["Sum"])
 
     if len(bic) != 9:
         return "bad_bic"
@@ -413,7 +716,8 @@ def _validate_st00012(st: str) -> Optional[str]:
         return "bad_personal"
     if len(ca) != 20:
         return "bad_corresp"
-    if not s.isdigit() or int(s) <= 0:
+    # только ASCII-цифры: isdigit() пропустил бы «١٢٣» и надстрочные «²»
+    if not (s.isascii() and s.isdigit()) or int(s) <= 0:
         return "bad_sum"
 
     purpose = (fields.get("Purpose") or "").strip()
@@ -489,107 +793,259 @@ SYSTEM_PROMPT = (
     "Все номера счетов/БИК выводи цифрами без пробелов: PersonalAcc=20, CorrespAcc=20, BIC=9."
 )
 
-def _client() -> OpenAI:
+def _api_key() -> str:
     api_key = os.getenv("OPENAI_API_KEY", "")
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY is missing")
-    return OpenAI(api_key=api_key)
+    return api_key
+
+def _aclient() -> AsyncOpenAI:
+    # один клиент на цикл (как и семафор): внутри цикла переиспользуем пул
+    # соединений (keep-alive, TLS), HTTP/2 — основной запрос и повтор идут по одному соединению
+    loop = asyncio.get_running_loop()
+    client = _ACLIENTS.get(loop)
+    if client is None:
+        import httpx
+        from openai import AsyncOpenAI
+        http_client = httpx.AsyncClient(
+            http2=True,
+            timeout=60,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        )
+        # повторы делаем сами (_chat_completion) — встроенные отключаем
+        client = _ACLIENTS[loop] = AsyncOpenAI(api_key=_api_key(), http_client=http_client, max_retries=0)
+    return client
+
+_JSON_OBJ_RE = None  # рекурсивный шаблон модуля regex, компилируется при первой нужде
 
 def _parse_json(text: str) -> dict:
+    # json_object-режим почти всегда отдаёт чистый JSON — парсим как есть;
+    # строка/массив/число на верхнем уровне — не ответ, ищем объект внутри
+    try:
+        data = _json_loads(text)
+        if isinstance(data, dict):
+            return data
+    except ValueError:
+        pass
     s, e = text.find("{"), text.rfind("}")
     if s == -1 or e == -1 or e <= s:
         raise ValueError("no JSON object found")
-    return json.loads(text[s:e+1])
+    # срез и _first_json_object начинаются с «{» — результат всегда объект
+    try:
+        return _json_loads(text[s:e+1])
+    except ValueError:
+        obj = _first_json_object(text)
+        if obj is None:
+            raise
+        return _json_loads(obj)
+
+def _first_json_object(text: str) -> Optional[str]:
+    """Первый сбалансированный {...} (мусор после объекта ломает срез по rfind)."""
+    global _JSON_OBJ_RE
+    if _JSON_OBJ_RE is None:
+        try:
+            import regex
+        except ImportError:
+            return None
+        _JSON_OBJ_RE = regex.compile(r"\{(?:[^{}]|(?R))*\}")
+    m = _JSON_OBJ_RE.search(text)
+    return m.group(0) if m else None
+
+# asyncio-примитивы привязаны к своему циклу: у бота это цикл PTB, у Flask —
+# фоновый _sync_loop(); семафор и клиент заводим на каждый цикл
+_GPT_SEMS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+_ACLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncOpenAI]" = weakref.WeakKeyDictionary()
+# single-flight: одинаковые запросы (файл, модель, диалог) ждут один вызов
+_INFLIGHT: dict[str, asyncio.Task] = {}
+
+def _gpt_sem() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    sem = _GPT_SEMS.get(loop)
+    if sem is None:
+        sem = _GPT_SEMS[loop] = asyncio.Semaphore(GPT_CONCURRENCY)
+    return sem
+
+async def _chat_completion(body: dict) -> str:
+    """Текст ответа chat.completions под семафором; 429, таймауты, обрывы соединения
+    и 5xx — повтор с экспоненциальной паузой (1, 2, 4… с + джиттер), семафор на паузе отпущен."""
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+    client = _aclient()
+    for attempt in range(GPT_API_ATTEMPTS):
+        try:
+            async with _gpt_sem():
+                return await _stream_reply(client, body)
+        # APITimeoutError — подкласс APIConnectionError
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            if attempt == GPT_API_ATTEMPTS - 1:
+                raise
+            delay = 2 ** attempt + random.random()
+            log.warning("OpenAI %s, retry in %.1fs", type(e).__name__, delay)
+            await asyncio.sleep(delay)
+
+async def _stream_reply(client: AsyncOpenAI, body: dict) -> str:
+    """Ответ потоком до закрытия JSON-объекта верхнего уровня: хвост не ждём
+    (в json_object-режиме модель иногда дописывает пробелы до лимита токенов)."""
+    stream = await client.chat.completions.create(**body, stream=True)
+    parts: List[str] = []
+    depth = 0
+    in_str = esc = False
+    try:
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            parts.append(delta)
+            for ch in delta:
+                if in_str:
+                    if esc:
+                        esc = False
+                    elif ch == "\\":
+                        esc = True
+                    elif ch == '"':
+                        in_str = False
+                elif ch == '"':
+                    in_str = True
+                elif ch == "{":
+                    depth += 1
+                elif ch == "}" and depth:
+                    depth -= 1
+                    if depth == 0:
+                        return "".join(parts)
+    finally:
+        await stream.close()
+    return "".join(parts)
+
+def _gpt_request_key(file_key: str, file_type: str, model: str, extra_messages: Optional[List[dict]]) -> str:
+    h = hashlib.sha256(f"{file_key}|{file_type}|{model}|".encode("utf-8"))
+    if extra_messages:
+        h.update(_json_dumps(extra_messages).encode("utf-8"))
+    return h.hexdigest()
 
 async def _call_gpt_on_file(
-    file_bytes: bytes,
+    file_key: str,
+    file_type: str,
+    user_content: List[dict],
+    model: Optional[str] = None,
+    extra_messages: Optional[List[dict]] = None,
+) -> Tuple[Optional[str], Optional[dict], Optional[str]]:
+    """GPT-разбор файла (file_key — sha256 байтов, user_content — из _build_user_content):
+    не больше GPT_CONCURRENCY запросов разом, одинаковые запросы (два пользователя
+    прислали один счёт) делят один вызов."""
+    key = _gpt_request_key(file_key, file_type, model or GPT_MODEL, extra_messages)
+    loop = asyncio.get_running_loop()
+    task = _INFLIGHT.get(key)
+    if task is None or task.get_loop() is not loop:
+        task = loop.create_task(_call_gpt_on_file_once(user_content, model, extra_messages))
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda t: _INFLIGHT.pop(key, None) if _INFLIGHT.get(key) is t else None)
+    # shield: отмена одного ожидающего не должна отменять общий запрос
+    return await asyncio.shield(task)
+
+# контент user-сообщения по типу файла: (content, None) или (None, причина)
+ContentResult = Tuple[Optional[List[dict]], Optional[str]]
+
+def _content_photo(file_bytes: BytesLike, hint: str, docx_text: str) -> ContentResult:
+    mime = _guess_mime_for_photo()
+    data_uri = _to_data_uri(_shrink_photo(file_bytes), mime)
+    return [
+        {"type": "text", "text": "Извлеки реквизиты по изображению счёта и верни JSON как описано."},
+        {"type": "text", "text": hint},
+        {"type": "image_url", "image_url": {"url": data_uri}},
+    ], None
+
+def _content_document(file_bytes: BytesLike, hint: str, docx_text: str) -> ContentResult:
+    if _is_pdf(file_bytes):
+        return _content_pdf(file_bytes, hint)
+    return _content_docx(file_bytes, hint, docx_text)
+
+def _content_pdf(file_bytes: BytesLike, hint: str) -> ContentResult:
+    txt = _pdf_to_text(file_bytes)
+    if txt and txt.strip():
+        return [
+            {"type": "text", "text": "Ниже текст документа (PDF). Верни JSON как описано."},
+            {"type": "text", "text": hint},
+            {"type": "text", "text": txt[:15000]},
+        ], None
+    images = _pdf_to_images(file_bytes, max_pages=3)
+    if not images:
+        return None, "PDF is a scan and could not be rendered to images"
+    user_content = [
+        {"type": "text", "text": "PDF выглядит как скан. Проанализируй изображения страниц и верни JSON как описано."},
+        {"type": "text", "text": hint},
+    ]
+    for img in images:
+        user_content.append({"type": "image_url", "image_url": {"url": _to_data_uri(img, "image/jpeg")}})
+    return user_content, None
+
+def _content_docx(file_bytes: BytesLike, hint: str, docx_text: str) -> ContentResult:
+    if docx_text and docx_text.strip():
+        return [
+            {"type": "text", "text": "Ниже текст из DOCX. Верни JSON как описано."},
+            {"type": "text", "text": hint},
+            {"type": "text", "text": docx_text[:15000]},
+        ], None
+    images = _docx_images(file_bytes, max_images=5)
+    if not images:
+        return [
+            {"type": "text", "text": "Текст/изображения из DOCX не извлечены. Верни JSON как описано, если возможно."},
+            {"type": "text", "text": hint},
+        ], None
+    user_content = [
+        {"type": "text", "text": "DOCX содержит изображения счёта. Проанализируй картинки и верни JSON как описано."},
+        {"type": "text", "text": hint},
+    ]
+    for img in images:
+        mime = "image/png" if img[:8].startswith(b"\x89PNG") else "image/jpeg"
+        user_content.append({"type": "image_url", "image_url": {"url": _to_data_uri(img, mime)}})
+    return user_content, None
+
+def _content_excel(file_bytes: BytesLike, hint: str, docx_text: str) -> ContentResult:
+    txt = _excel_to_text(file_bytes)
+    return [
+        {"type": "text", "text": "Ниже текстовое представление Excel/CSV-счёта. Верни JSON как описано."},
+        {"type": "text", "text": hint},
+        {"type": "text", "text": txt[:15000] if txt else ""},
+    ], None
+
+def _content_default(file_bytes: BytesLike, hint: str, docx_text: str) -> ContentResult:
+    txt = _pdf_to_text(file_bytes)
+    return [
+        {"type": "text", "text": "Ниже текст из документа. Верни JSON как описано."},
+        {"type": "text", "text": hint},
+        {"type": "text", "text": txt[:15000] if txt else ""},
+    ], None
+
+_CONTENT_BUILDERS = {
+    "photo": _content_photo,
+    "document": _content_document,
+    "excel": _content_excel,
+}
+
+def _build_user_content(
+    file_bytes: BytesLike,
     file_type: str,
     prehint: dict,
     docx_text: str = "",
-    model: Optional[str] = None
-) -> Tuple[Optional[str], Optional[dict], Optional[str]]:
-    client = _client()
-    mdl = model or GPT_MODEL
-
-    if file_type == "photo":
-        mime = _guess_mime_for_photo()
-        data_uri = _to_data_uri(file_bytes, mime)
-        user_content = [
-            {"type": "text", "text": "Извлеки реквизиты по изображению счёта и верни JSON как описано."},
-            {"type": "text", "text": f"Подсказки (если релевантны): {json.dumps(prehint, ensure_ascii=False)}"},
-            {"type": "image_url", "image_url": {"url": data_uri}},
-        ]
-    elif file_type == "document":
-        if _is_pdf(file_bytes):
-            txt = _pdf_to_text(file_bytes)
-            if txt and txt.strip():
-                user_content = [
-                    {"type": "text", "text": "Ниже текст документа (PDF). Верни JSON как описано."},
-                    {"type": "text", "text": f"Подсказки (если релевантны): {json.dumps(prehint, ensure_ascii=False)}"},
-                    {"type": "text", "text": txt[:15000]},
-                ]
-            else:
-                images = _pdf_to_images(file_bytes, max_pages=3, dpi=360)
-                if not images:
-                    return None, None, "PDF is a scan and could not be rendered to images"
-                user_content = [
-                    {"type": "text", "text": "PDF выглядит как скан. Проанализируй изображения страниц и верни JSON как описано."},
-                    {"type": "text", "text": f"Подсказки (если релевантны): {json.dumps(prehint, ensure_ascii=False)}"},
-                ]
-                for img in images:
-                    user_content.append({"type": "image_url", "image_url": {"url": _to_data_uri(img, "image/png")}})
-        else:
-            # DOCX
-            if docx_text and docx_text.strip():
-                user_content = [
-                    {"type": "text", "text": "Ниже текст из DOCX. Верни JSON как описано."},
-                    {"type": "text", "text": f"Подсказки (если релевантны): {json.dumps(prehint, ensure_ascii=False)}"},
-                    {"type": "text", "text": docx_text[:15000]},
-                ]
-            else:
-                images = _docx_images(file_bytes, max_images=5)
-                if images:
-                    user_content = [
-                        {"type": "text", "text": "DOCX содержит изображения счёта. Проанализируй картинки и верни JSON как описано."},
-                        {"type": "text", "text": f"Подсказки (если релевантны): {json.dumps(prehint, ensure_ascii=False)}"},
-                    ]
-                    for img in images:
-                        mime = "image/png" if img[:8].startswith(b"\x89PNG") else "image/jpeg"
-                        user_content.append({"type": "image_url", "image_url": {"url": _to_data_uri(img, mime)}})
-                else:
-                    user_content = [
-                        {"type": "text", "text": "Текст/изображения из DOCX не извлечены. Верни JSON как описано, если возможно."},
-                        {"type": "text", "text": f"Подсказки (если релевантны): {json.dumps(prehint, ensure_ascii=False)}"},
-                    ]
-    elif file_type == "excel":
-        txt = _excel_to_text(file_bytes)
-        user_content = [
-            {"type": "text", "text": "Ниже текстовое представление Excel/CSV-счёта. Верни JSON как описано."},
-            {"type": "text", "text": f"Подсказки (если релевантны): {json.dumps(prehint, ensure_ascii=False)}"},
-            {"type": "text", "text": txt[:15000] if txt else ""},
-        ]
-    else:
-        txt = _pdf_to_text(file_bytes)
-        user_content = [
-            {"type": "text", "text": "Ниже текст из документа. Верни JSON как описано."},
-            {"type": "text", "text": f"Подсказки (если релевантны): {json.dumps(prehint, ensure_ascii=False)}"},
-            {"type": "text", "text": txt[:15000] if txt else ""},
-        ]
-
-    try:
-        resp = client.chat.completions.create(
-            model=mdl,
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_content},
-            ],
-            temperature=0.0,
-        )
-        raw = resp.choices[0].message.content or ""
-    except Exception as e:
-        return None, None, f"GPT error: {e}"
+) -> ContentResult:
+    """Контент user-сообщения для GPT по типу файла; (None, причина), если отправить нечего."""
+    hint = f"Подсказки (если релевантны): {_json_dumps(prehint)}"
+    builder = _CONTENT_BUILDERS.get(file_type, _content_default)
+    return builder(file_bytes, hint, docx_text)
+
+def _gpt_request_body(model: str, user_content: List[dict], extra_messages: Optional[List[dict]] = None) -> dict:
+    """Параметры chat.completions — общие для онлайн-вызова и Batch API."""
+    return {
+        "model": model,
+        "response_format": {"type": "json_object"},
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_content},
+            *(extra_messages or []),
+        ],
+        "temperature": 0.0,
+    }
 
+def _result_from_reply(raw: str) -> Tuple[Optional[str], Optional[dict], Optional[str]]:
     try:
         data = _parse_json(raw)
     except Exception as e:
@@ -600,44 +1056,168 @@ async def _call_gpt_on_file(
     notes = data.get("notes") or ""
     return st, fields, notes
 
-# -------- main entry --------
-async def on_approved_send_qr(context: ContextTypes.DEFAULT_TYPE, *, chat_id: int, status_msg_id: int) -> None:
-    inv = store.get(status_msg_id)
-    if not inv or not inv.get("src"):
-        log.warning("No source bound to status_msg_id=%s", status_msg_id)
-        return
-
-    src = inv["src"]
-    file_id = src["file_id"]
-    file_type = src["file_type"]   # "document" | "photo" | "excel"
-    thread_id = src.get("thread_id")
-
-    tg_file = await context.bot.get_file(file_id)
-    fb = await tg_file.download_as_bytearray()
-    b = bytes(fb)
-
-    # Подсказки для GPT
-    base_text = ""
-    docx_text = ""
-    if file_type == "document":
-        if _is_pdf(b):
-            base_text = _pdf_to_text(b)
+class GptBatcher:
+    """Микробатчер первых запросов к GPT_MODEL: счета, пришедшие в пределах
+    окна, уходят одним запросом — системный промпт оплачивается один раз.
+    Одиночный запрос (очередь пуста) идёт обычным вызовом."""
+
+    def __init__(self, model: str, max_batch: int, window: float) -> None:
+        self.model = model
+        self.max_batch = max_batch
+        self.window = window
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, user_content: List[dict]) -> str:
+        """JSON-ответ модели для одного счёта."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.put_nowait((user_content, fut))
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+        return await fut
+
+    async def _run(self) -> None:
+        # воркер живёт, пока есть очередь: циклу Flask-запроса не остаётся висящих задач
+        loop = asyncio.get_running_loop()
+        while not self._queue.empty():
+            batch = [self._queue.get_nowait()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = loop.create_task(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: List[Tuple[List[dict], asyncio.Future]]) -> None:
+        replies: dict = {}
+        if len(batch) > 1:
+            try:
+                replies = await self._multi([content for content, _ in batch])
+            except Exception as e:
+                # общий ответ не разобрался — каждый счёт по одному, первая попытка не теряется
+                log.warning("GPT micro-batch failed, falling back to single requests: %s", e)
+
+        async def settle(i: int, content: List[dict], fut: asyncio.Future) -> None:
+            # счета, пропущенные (или отбракованные) в общем ответе, — по одному
+            try:
+                reply = replies[i] if i in replies else await self._single(content)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+                return
+            if not fut.done():
+                fut.set_result(reply)
+
+        await asyncio.gather(*(settle(i, content, fut) for i, (content, fut) in enumerate(batch)))
+
+    async def _single(self, user_content: List[dict]) -> str:
+        return await _chat_completion(_gpt_request_body(self.model, user_content))
+
+    async def _multi(self, contents: List[List[dict]]) -> dict:
+        user_content: List[dict] = []
+        for i, content in enumerate(contents):
+            user_content.append({"type": "text", "text": f"Счёт {i}:"})
+            user_content.extend(content)
+        user_content.append({"type": "text", "text": (
+            f"Выше {len(contents)} разных счетов. Разбери каждый отдельно и верни JSON "
+            '{"results":[{"id":<номер счёта>,"st":"...","fields":{...},"notes":"..."}]} — '
+            "по объекту на каждый счёт, поля как описано для одного счёта."
+        )})
+        data = _parse_json(await _chat_completion(_gpt_request_body(self.model, user_content)))
+        replies = {}
+        for item in data.get("results") or []:
+            try:
+                i = int(item.get("id"))
+            except (TypeError, ValueError):
+                continue
+            if 0 <= i < len(contents) and _reply_matches_content(item, contents[i]):
+                replies[i] = _json_dumps({k: item.get(k) for k in ("st", "fields", "notes")})
+        log.info("GPT micro-batch: %d invoices in one request, %d parsed", len(contents), len(replies))
+        return replies
+
+_ST_PERSONAL_RE = re.compile(r"PersonalAcc=(\d{20})")
+
+def _reply_matches_content(item: dict, content: List[dict]) -> bool:
+    """Ответ из общего JSON относится к своему счёту: для текстовых счетов р/с
+    должен встречаться в тексте документа (перепутанные id проходят валидацию
+    по отдельности). Для изображений проверить нечем — принимаем."""
+    if any(part.get("type") != "text" for part in content):
+        return True
+    fields = item.get("fields") if isinstance(item.get("fields"), dict) else {}
+    acc = str(fields.get("PersonalAcc") or "")
+    if not acc:
+        m = _ST_PERSONAL_RE.search(str(item.get("st") or ""))
+        acc = m.group(1) if m else ""
+    text = "".join(part.get("text") or "" for part in content).replace(" ", "").replace(NBSP, "")
+    return bool(acc) and acc in text
+
+# батчер держит очередь и задачи своего цикла — как семафор и клиент
+_BATCHERS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, GptBatcher]" = weakref.WeakKeyDictionary()
+
+def _batcher() -> GptBatcher:
+    loop = asyncio.get_running_loop()
+    b = _BATCHERS.get(loop)
+    if b is None:
+        b = _BATCHERS[loop] = GptBatcher(GPT_MODEL, GPT_MICROBATCH, GPT_MICROBATCH_WINDOW)
+    return b
+
+async def _call_gpt_on_file_once(
+    user_content: List[dict],
+    model: Optional[str] = None,
+    extra_messages: Optional[List[dict]] = None,
+) -> Tuple[Optional[str], Optional[dict], Optional[str]]:
+    try:
+        if GPT_MICROBATCH > 1 and not extra_messages and (model or GPT_MODEL) == GPT_MODEL:
+            raw = await _batcher().submit(user_content)
         else:
-            docx_text = _docx_to_text(b)
-            base_text = docx_text
-    elif file_type == "excel":
-        base_text = _excel_to_text(b)
-    prehint = _pre_hint(base_text)
+            raw = await _chat_completion(_gpt_request_body(model or GPT_MODEL, user_content, extra_messages))
+    except Exception as e:
+        return None, None, f"GPT error: {e}"
 
-    # 1-я попытка
-    st, fields, notes = await _call_gpt_on_file(b, file_type, prehint, docx_text=docx_text, model=GPT_MODEL)
+    return _result_from_reply(raw)
+
+# поля, которые GPT должен исправить, по коду ошибки валидации
+_ERR_FIELDS = {
+    "bad_bic": ["BIC"],
+    "bad_personal": ["PersonalAcc"],
+    "bad_corresp": ["CorrespAcc"],
+    "bad_sum": ["Sum"],
+    "bad_purpose": ["Purpose"],
+}
+
+def _feedback_messages(st: Optional[str], fields: Optional[dict], notes: Optional[str], err_code: str) -> List[dict]:
+    """Предыдущий ответ + причина отказа валидации — для повторного запроса к GPT."""
+    if err_code.startswith("missing:"):
+        bad = err_code.split(":", 1)[1].split(",")
+    else:
+        bad = _ERR_FIELDS.get(err_code, [])
+    reason = _reason_human(err_code, None, fields)
+    text = f"Предыдущий ответ не прошёл валидацию: {reason}"
+    if bad:
+        text += f" Исправь поля: {', '.join(bad)}."
+    text += " Перепроверь документ и верни исправленный JSON как описано."
+    prev = {"st": st or "", "fields": fields or {}, "notes": notes or ""}
+    return [
+        {"role": "assistant", "content": _json_dumps(prev)},
+        {"role": "user", "content": text},
+    ]
 
+def _finalize_attempt(st: Optional[str], fields: Optional[dict]) -> Tuple[Optional[str], Optional[dict], Optional[str]]:
+    """Очистка полей, сборка ST00012 из полей при необходимости и валидация."""
     if fields:
         fields = _sanitize_fields(fields)
 
     if (not st or not st.startswith("ST00012|")) and fields:
-        if "Sum" in fields and fields["Sum"] and not fields["Sum"].isdigit():
-            rub = re.sub(r"[^\d,\.]", "", fields["Sum"]).replace(",", ".")
+        if "Sum" in fields and fields["Sum"] and not str(fields["Sum"]).isdigit():
+            rub = _MONEY_STRIP_RE.sub("", str(fields["Sum"])).replace(",", ".")
             try:
                 fields["Sum"] = str(int(round(float(rub) * 100)))
             except Exception:
@@ -645,36 +1225,260 @@ async def on_approved_send_qr(context: ContextTypes.DEFAULT_TYPE, *, chat_id: in
         st = _build_st00012_from_fields(fields)
 
     err_code = _validate_st00012(st) if st else "payload is not ST00012"
+    return st, fields, err_code
+
+LOCAL_PARSE_NOTE = "Реквизиты распознаны из текста документа без GPT."
+
+def _extract_locally(base_text: str, prehint: dict) -> Optional[Tuple[str, dict]]:
+    """(st, fields), если реквизиты целиком и валидно нашлись в тексте документа."""
+    local = _local_extract_fields(base_text, prehint) if base_text else {}
+    if not local:
+        return None
+    st, fields, err_code = _finalize_attempt(None, local)
+    if err_code:
+        return None
+    log.info("Invoice requisites parsed locally, GPT skipped")
+    return st, fields
 
-    # автоповтор
-    retries_left = MAX_RETRY_ON_FAIL if GPT_MODEL != RETRY_MODEL else 0
+async def _extract_invoice(
+    file_bytes: BytesLike,
+    file_type: str,
+    prehint: dict,
+    docx_text: str = "",
+    base_text: str = "",
+) -> Tuple[Optional[str], Optional[dict], Optional[str], Optional[str]]:
+    """Сначала локальный разбор текста документа, затем кэш успешных разборов;
+    если ничего не нашлось — GPT_MODEL, при провале валидации — повтор на RETRY_MODEL с предыдущим
+    ответом и причиной отказа в диалоге."""
+    local = _extract_locally(base_text, prehint)
+    if local:
+        return local[0], local[1], LOCAL_PARSE_NOTE, None
+
+    # повторно присланный счёт: берём успешный разбор из кэша
+    cache = _disk_cache()
+    file_key = hashlib.sha256(file_bytes).hexdigest()
+    key = _invoice_cache_key(file_key, file_type)
+    if cache is not None:
+        hit = cache.get(key)
+        if hit is not None:
+            data = _json_loads(hit)
+            log.info("Invoice parse taken from cache")
+            return data["st"], data["fields"], data["notes"], None
+
+    # user-контент (текст, base64 страниц/фото) собираем один раз — его же шлют
+    # и повторы; рендер страниц/сжатие фото/base64 — CPU, уводим из цикла
+    user_content, err = await asyncio.to_thread(_build_user_content, file_bytes, file_type, prehint, docx_text)
+    if user_content is None:
+        return None, None, None, err
+
+    st, fields, notes = await _call_gpt_on_file(file_key, file_type, user_content, model=GPT_MODEL)
+    st, fields, err_code = _finalize_attempt(st, fields)
+
+    # автоповтор: с обратной связью имеет смысл даже на той же модели
+    prev = (st, fields, notes, err_code)
+    retries_left = MAX_RETRY_ON_FAIL
     while err_code and retries_left > 0:
         retries_left -= 1
-        st2, fields2, notes2 = await _call_gpt_on_file(b, file_type, prehint, docx_text=docx_text, model=RETRY_MODEL)
-        if fields2:
-            fields2 = _sanitize_fields(fields2)
-        if (not st2 or not st2.startswith("ST00012|")) and fields2:
-            if "Sum" in fields2 and fields2["Sum"] and not fields2["Sum"].isdigit():
-                rub = re.sub(r"[^\d,\.]", "", fields2["Sum"]).replace(",", ".")
-                try:
-                    fields2["Sum"] = str(int(round(float(rub) * 100)))
-                except Exception:
-                    pass
-            st2 = _build_st00012_from_fields(fields2)
-        err2 = _validate_st00012(st2) if st2 else "payload is not ST00012"
+        # пустой ответ (ошибка API/JSON) нечем комментировать — повторяем как есть
+        extra = _feedback_messages(*prev) if (prev[0] or prev[1]) else None
+        st2, fields2, notes2 = await _call_gpt_on_file(
+            file_key, file_type, user_content, model=RETRY_MODEL, extra_messages=extra,
+        )
+        st2, fields2, err2 = _finalize_attempt(st2, fields2)
+        prev = (st2, fields2, notes2, err2)
         # берём лучший вариант
-        if not err2 or (err2 and st2 and fields2 and len(_fields_preview(fields2)) > len(_fields_preview(fields or {}))):
+        if not err2 or (fields2 and len(_fields_preview(fields2)) > len(_fields_preview(fields or {}))):
             st, fields, notes, err_code = st2, fields2, notes2, err2
             break
 
+    if cache is not None and not err_code:
+        cache.set(key, _json_dumps({"st": st, "fields": fields, "notes": notes}), expire=CACHE_TTL)
+    return st, fields, notes, err_code
+
+def _invoice_cache_key(file_key: str, file_type: str) -> str:
+    return f"gpt:{file_key}:{file_type}:{GPT_MODEL}:{RETRY_MODEL}:{PROMPT_VERSION}"
+
+# -------- main entry --------
+async def _load_invoice_file(
+    context: ContextTypes.DEFAULT_TYPE, status_msg_id: int
+) -> Optional[Tuple[BytesLike, str, Optional[int]]]:
+    """Скачивает исходный файл счёта: (байты, file_type, thread_id) или None."""
+    inv = store.get(status_msg_id)
+    if not inv or not inv.src:
+        log.warning("No source bound to status_msg_id=%s", status_msg_id)
+        return None
+
+    src = inv.src
+    tg_file = await context.bot.get_file(src.file_id)
+    # bytearray отдаём дальше как есть: все потребители принимают bytes-like,
+    # а копия bytes(...) удваивала пик памяти на больших сканах
+    b = await tg_file.download_as_bytearray()
+    return b, src.file_type, src.thread_id   # file_type: "document" | "photo" | "excel"
+
+def _document_texts(b: BytesLike, file_type: str) -> Tuple[str, str]:
+    """Текст документа для подсказок и локального разбора: (base_text, docx_text)."""
+    base_text = ""
+    docx_text = ""
+    if file_type == "document":
+        if _is_pdf(b):
+            base_text = _pdf_to_text(b)
+        else:
+            docx_text = _docx_to_text(b)
+            base_text = docx_text
+    elif file_type == "excel":
+        base_text = _excel_to_text(b)
+    return base_text, docx_text
+
+async def on_approved_send_qr(context: ContextTypes.DEFAULT_TYPE, *, chat_id: int, status_msg_id: int) -> None:
+    loaded = await _load_invoice_file(context, status_msg_id)
+    if loaded is None:
+        return
+    b, file_type, thread_id = loaded
+
+    # Подсказки для GPT; разбор PDF/Excel/DOCX — в потоке, цикл бота не ждёт
+    base_text, docx_text = await asyncio.to_thread(_document_texts, b, file_type)
+    prehint = _pre_hint(base_text)
+
+    st, fields, notes, err_code = await _extract_invoice(b, file_type, prehint, docx_text=docx_text, base_text=base_text)
+    await _send_result(
+        context, chat_id=chat_id, status_msg_id=status_msg_id, thread_id=thread_id,
+        st=st, fields=fields, notes=notes, err_code=err_code,
+    )
+
+# -------- пакетный разбор (processor_batch) --------
+def openai_client() -> AsyncOpenAI:
+    """Клиент OpenAI текущего цикла — общий пул соединений с онлайн-разбором."""
+    return _aclient()
+
+async def prepare_gpt_request(
+    context: ContextTypes.DEFAULT_TYPE, *, chat_id: int, status_msg_id: int
+) -> Optional[Tuple[dict, Optional[int]]]:
+    """Тело запроса chat.completions для счёта и thread_id карточки.
+
+    Счёт, разобранный локально или негодный для GPT, обрабатывается сразу
+    (результат уходит в чат) — тогда, как и без исходного файла, возвращается None."""
+    loaded = await _load_invoice_file(context, status_msg_id)
+    if loaded is None:
+        return None
+    b, file_type, thread_id = loaded
+
+    base_text, docx_text = await asyncio.to_thread(_document_texts, b, file_type)
+    prehint = _pre_hint(base_text)
+    local = _extract_locally(base_text, prehint)
+    if local:
+        await _send_result(
+            context, chat_id=chat_id, status_msg_id=status_msg_id, thread_id=thread_id,
+            st=local[0], fields=local[1], notes=LOCAL_PARSE_NOTE, err_code=None,
+        )
+        return None
+
+    user_content, err = await asyncio.to_thread(_build_user_content, b, file_type, prehint, docx_text)
+    if user_content is None:
+        await _send_result(
+            context, chat_id=chat_id, status_msg_id=status_msg_id, thread_id=thread_id,
+            st=None, fields=None, notes=None, err_code=err,
+        )
+        return None
+    return _gpt_request_body(GPT_MODEL, user_content), thread_id
+
+async def deliver_gpt_reply(
+    context: ContextTypes.DEFAULT_TYPE,
+    *,
+    chat_id: int,
+    status_msg_id: int,
+    thread_id: Optional[int],
+    raw: Optional[str],
+) -> None:
+    """QR по готовому ответу модели; нет ответа или он не прошёл проверку —
+    счёт заново разбирается онлайн-путём (с повтором и обратной связью)."""
+    if raw is not None:
+        st, fields, notes = _result_from_reply(raw)
+        st, fields, err_code = _finalize_attempt(st, fields)
+        if not err_code:
+            await _send_result(
+                context, chat_id=chat_id, status_msg_id=status_msg_id, thread_id=thread_id,
+                st=st, fields=fields, notes=notes, err_code=None,
+            )
+            return
+    await on_approved_send_qr(context, chat_id=chat_id, status_msg_id=status_msg_id)
+
+# QR-заглушка при неудаче: строка постоянная, PNG рендерится один раз (lru_cache)
+_DEMO_PAYLOAD = "ST00012|Name=ERROR|PersonalAcc=00000000000000000000|BankName=ERROR|BIC=000000000|CorrespAcc=00000000000000000000|Sum=0|Purpose=Parse failed"
+
+# payload → file_id уже загруженного в Telegram QR: повторная отправка
+# идёт ссылкой, без рендера и без загрузки PNG
+_FILE_ID_CACHE_SIZE = 512
+_FILE_ID_CACHE: "OrderedDict[str, str]" = OrderedDict()
+# ответы Bot API про негодный file_id («Wrong file identifier/HTTP URL specified»,
+# «Wrong remote file identifier specified: …»); прочие BadRequest — не про кэш
+_BAD_FILE_ID_MARKERS = ("file identifier", "file_id", "remote file")
+
+async def _send_qr_photo(context: ContextTypes.DEFAULT_TYPE, payload: str, **kwargs) -> None:
+    fid = _FILE_ID_CACHE.get(payload)
+    if fid is not None:
+        from telegram.error import BadRequest
+        try:
+            await context.bot.send_photo(photo=fid, **kwargs)
+            _FILE_ID_CACHE.move_to_end(payload)
+            return
+        except BadRequest as e:
+            # file_id протух — загружаем заново; остальные ошибки (подпись, чат,
+            # reply_to) повторная загрузка не исправит
+            if not any(m in str(e).lower() for m in _BAD_FILE_ID_MARKERS):
+                raise
+            log.warning("Cached QR file_id rejected, re-uploading: %s", e)
+            _FILE_ID_CACHE.pop(payload, None)
+
+    png = await asyncio.to_thread(_qr_png_bytes, payload)
+    msg = await context.bot.send_photo(photo=png, **kwargs)
+    if msg.photo:
+        _FILE_ID_CACHE[payload] = msg.photo[-1].file_id
+        while len(_FILE_ID_CACHE) > _FILE_ID_CACHE_SIZE:
+            _FILE_ID_CACHE.popitem(last=False)
+
+_TG_SEMS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+def _tg_sem() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    sem = _TG_SEMS.get(loop)
+    if sem is None:
+        sem = _TG_SEMS[loop] = asyncio.Semaphore(TG_CONCURRENCY)
+    return sem
+
+async def on_approved_send_qr_batch(
+    context: ContextTypes.DEFAULT_TYPE, *, chat_id: int, status_msg_ids: List[int]
+) -> None:
+    """Пакетное согласование: скачивание, разбор и отправка QR идут параллельно,
+    не больше TG_CONCURRENCY счетов разом (лимиты Bot API)."""
+    async def one(mid: int) -> None:
+        async with _tg_sem():
+            await on_approved_send_qr(context, chat_id=chat_id, status_msg_id=mid)
+
+    results = await asyncio.gather(*(one(mid) for mid in status_msg_ids), return_exceptions=True)
+    for mid, res in zip(status_msg_ids, results):
+        if isinstance(res, BaseException):
+            log.error("QR for status_msg_id=%s failed: %r", mid, res)
+
+async def _send_result(
+    context: ContextTypes.DEFAULT_TYPE,
+    *,
+    chat_id: int,
+    status_msg_id: int,
+    thread_id: Optional[int],
+    st: Optional[str],
+    fields: Optional[dict],
+    notes: Optional[str],
+    err_code: Optional[str],
+) -> None:
+    """QR с подписью под карточкой счёта, либо заглушка с причиной и распознанными полями."""
     # успех
     if not err_code and st and fields:
         try:
-            png = _qr_png_bytes(st)
             caption = _caption_from_fields(fields, notes=notes)
-            await context.bot.send_photo(
+            await _send_qr_photo(
+                context,
+                st,
                 chat_id=chat_id,
-                photo=png,
                 caption=caption,
                 message_thread_id=thread_id if thread_id else None,
                 reply_to_message_id=status_msg_id,
@@ -689,16 +1493,15 @@ async def on_approved_send_qr(context: ContextTypes.DEFAULT_TYPE, *, chat_id: in
     reason_block = f"\nПричина: {reason}" if reason else ""
     preview_block = f"\n\nРаспознанные поля (проверьте):\n{preview}" if preview else ""
 
-    demo_payload = "ST00012|Name=ERROR|PersonalAcc=00000000000000000000|BankName=ERROR|BIC=000000000|CorrespAcc=00000000000000000000|Sum=0|Purpose=Parse failed"
-    png = _qr_png_bytes(demo_payload)
     fallback_caption = (
         "Не удалось собрать рабочий QR. Проверьте реквизиты или пришлите более качественный образец для настройки."
         + reason_block + preview_block
     )
 
-    await context.bot.send_photo(
+    await _send_qr_photo(
+        context,
+        _DEMO_PAYLOAD,
         chat_id=chat_id,
-        photo=png,
         caption=fallback_caption,
         message_thread_id=thread_id if thread_id else None,
         reply_to_message_id=status_msg_id,
@@ -723,63 +1526,10 @@ def gpt_process(file_bytes: bytes, file_name: str) -> Tuple[bool, dict, str]:
 
     prehint = _pre_hint(base_text)
 
-    st, fields, notes = _run_coroutine_sync(
-        _call_gpt_on_file(
-            file_bytes,
-            file_type,
-            prehint,
-            docx_text=docx_text,
-            model=GPT_MODEL,
-        )
+    st, fields, notes, err_code = _run_coroutine_sync(
+        _extract_invoice(file_bytes, file_type, prehint, docx_text=docx_text, base_text=base_text)
     )
 
-    if fields:
-        fields = _sanitize_fields(fields)
-
-    if (not st or not st.startswith("ST00012|")) and fields:
-        if "Sum" in fields and fields["Sum"] and not str(fields["Sum"]).isdigit():
-            rub = re.sub(r"[^\d,\.]", "", str(fields["Sum"]))
-            rub = rub.replace(",", ".")
-            try:
-                fields["Sum"] = str(int(round(float(rub) * 100)))
-            except Exception:
-                pass
-        st = _build_st00012_from_fields(fields)
-
-    err_code = _validate_st00012(st) if st else "payload is not ST00012"
-
-    retries_left = MAX_RETRY_ON_FAIL if GPT_MODEL != RETRY_MODEL else 0
-    while err_code and retries_left > 0:
-        retries_left -= 1
-        st2, fields2, notes2 = _run_coroutine_sync(
-            _call_gpt_on_file(
-                file_bytes,
-                file_type,
-                prehint,
-                docx_text=docx_text,
-                model=RETRY_MODEL,
-            )
-        )
-        if fields2:
-            fields2 = _sanitize_fields(fields2)
-        if (not st2 or not st2.startswith("ST00012|")) and fields2:
-            if "Sum" in fields2 and fields2["Sum"] and not str(fields2["Sum"]).isdigit():
-                rub = re.sub(r"[^\d,\.]", "", str(fields2["Sum"]))
-                rub = rub.replace(",", ".")
-                try:
-                    fields2["Sum"] = str(int(round(float(rub) * 100)))
-                except Exception:
-                    pass
-            st2 = _build_st00012_from_fields(fields2)
-        err2 = _validate_st00012(st2) if st2 else "payload is not ST00012"
-        if not err2 or (
-            err2
-            and fields2
-            and len(_fields_preview(fields2)) > len(_fields_preview(fields or {}))
-        ):
-            st, fields, notes, err_code = st2, fields2, notes2, err2
-            break
-
     if not err_code and st and fields:
         return True, fields, notes or ""
 
@@ -805,4 +1555,23 @@ def make_qr_png(st: str) -> bytes:
     if not st or not st.startswith("ST00012|"):
         raise ValueError("st must be ST00012 payload")
     return _qr_png_bytes(st)
+
+
+def warmup_sync() -> None:
+    """Прогрев при старте: импорт тяжёлых модулей, дисковый кэш и QR-заглушка —
+    чтобы за это не платил первый согласованный счёт."""
+    for name in ("httpx", "openai", "segno"):
+        try:
+            __import__(name)
+        except Exception as e:
+            log.warning("Warmup: %s import failed: %s", name, e)
+    _disk_cache()
+    try:
+        _qr_png_bytes(_DEMO_PAYLOAD)
+    except Exception as e:
+        log.warning("Warmup: QR render failed: %s", e)
+
+
+async def warmup() -> None:
+    await asyncio.to_thread(warmup_sync)
 
@@ -0,0 +1,152 @@
+# processor_batch.py — пакетный GPT-разбор счетов через OpenAI Batch API
+# Для массовых/несрочных согласований: токены вдвое дешевле, ответ — в пределах 24 ч.
+# Онлайн-путь (processor.on_approved_send_qr) не меняется и остаётся запасным:
+# через него заново разбираются счета, с которыми батч не справился.
+# id батча хранится в store (Invoice.batch): после перезапуска бота опрос
+# незавершённых батчей возобновляет resume_pending_batches().
+
+from __future__ import annotations
+import asyncio
+import json
+import logging
+import os
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from store import store
+from processor import deliver_gpt_reply, openai_client, prepare_gpt_request
+
+if TYPE_CHECKING:
+    from telegram.ext import ContextTypes
+
+log = logging.getLogger("processor_batch")
+
+BATCH_POLL_SECONDS = int(os.getenv("GPT_BATCH_POLL_SECONDS", "60"))
+_BATCH_DONE = {"completed", "failed", "expired", "cancelled"}
+
+# фоновые опросы батчей: держим ссылки, иначе задачи может собрать GC
+_POLLERS: set[asyncio.Task] = set()
+
+
+async def submit_batch(context: ContextTypes.DEFAULT_TYPE, status_msg_ids: List[int]) -> Optional[str]:
+    """Отправляет согласованные счета одним батчем и запускает фоновый опрос.
+
+    Результат уходит в чат исходного сообщения счёта (Invoice.src); счета без
+    источника пропускаются. Счета, которые разбираются локально (или которые
+    нечем отправить в GPT), обрабатываются сразу. Возвращает id батча или None,
+    если в батч ничего не попало."""
+    lines: List[dict] = []
+    targets: Dict[int, Tuple[int, Optional[int]]] = {}   # status_msg_id -> (chat_id, thread_id)
+    for mid in dict.fromkeys(status_msg_ids):   # повтор custom_id — батч отклоняется целиком
+        inv = store.get(mid)
+        if not inv or not inv.src:
+            log.warning("No source bound to status_msg_id=%s, skipped", mid)
+            continue
+        chat_id = inv.src.chat_id
+        prepared = await prepare_gpt_request(context, chat_id=chat_id, status_msg_id=mid)
+        if prepared is None:
+            continue
+        body, thread_id = prepared
+        lines.append({
+            "custom_id": str(mid),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body,
+        })
+        targets[mid] = (chat_id, thread_id)
+
+    if not lines:
+        return None
+
+    client = openai_client()
+    jsonl = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines).encode("utf-8")
+    batch_file = await client.files.create(file=("invoices.jsonl", jsonl), purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    for mid in targets:
+        store.set_batch(mid, batch.id)
+    log.info("Submitted batch %s with %d invoices", batch.id, len(targets))
+
+    _start_poll(context, batch.id, targets)
+    return batch.id
+
+
+async def resume_pending_batches(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Возобновляет опрос батчей, не завершённых до перезапуска бота.
+
+    Счета с id батча в store группируются по батчу; возвращает число
+    возобновлённых опросов."""
+    groups: Dict[str, Dict[int, Tuple[int, Optional[int]]]] = {}
+    for mid, inv in store.items():
+        if inv.batch is None:
+            continue
+        if inv.src is None:
+            log.warning("Batch %s: no source for status_msg_id=%s, dropping", inv.batch, mid)
+            store.set_batch(mid, None)
+            continue
+        groups.setdefault(inv.batch, {})[mid] = (inv.src.chat_id, inv.src.thread_id)
+
+    for batch_id, targets in groups.items():
+        log.info("Resuming batch %s with %d invoices", batch_id, len(targets))
+        _start_poll(context, batch_id, targets)
+    return len(groups)
+
+
+def _start_poll(
+    context: ContextTypes.DEFAULT_TYPE, batch_id: str, targets: Dict[int, Tuple[int, Optional[int]]]
+) -> None:
+    task = asyncio.get_running_loop().create_task(_poll_batch(context, batch_id, targets))
+    _POLLERS.add(task)
+    task.add_done_callback(_POLLERS.discard)
+
+
+async def _poll_batch(
+    context: ContextTypes.DEFAULT_TYPE, batch_id: str, targets: Dict[int, Tuple[int, Optional[int]]]
+) -> None:
+    client = openai_client()
+    status = ""
+    output_file_id = None
+    while status not in _BATCH_DONE:
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        try:
+            batch = await client.batches.retrieve(batch_id)
+        except Exception as e:
+            log.warning("Batch %s poll failed: %s", batch_id, e)
+            continue
+        status, output_file_id = batch.status, batch.output_file_id
+
+    replies: Dict[int, str] = {}
+    if status == "completed" and output_file_id:
+        try:
+            content = await client.files.content(output_file_id)
+            replies = _parse_batch_output(content.text)
+        except Exception as e:
+            log.warning("Batch %s output download failed: %s", batch_id, e)
+    else:
+        log.warning("Batch %s finished with status %s", batch_id, status)
+
+    for mid, (chat_id, thread_id) in targets.items():
+        store.set_batch(mid, None)
+        try:
+            # без ответа или с непрошедшим проверку ответом — онлайн-путь
+            await deliver_gpt_reply(
+                context, chat_id=chat_id, status_msg_id=mid, thread_id=thread_id, raw=replies.get(mid),
+            )
+        except Exception:
+            log.exception("Batch %s: failed to deliver result for status_msg_id=%s", batch_id, mid)
+
+
+def _parse_batch_output(text: str) -> Dict[int, str]:
+    """status_msg_id -> ответ модели из output-файла батча (строки с ошибкой пропускаются)."""
+    out: Dict[int, str] = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        body = (item.get("response") or {}).get("body") or {}
+        choices = body.get("choices") or []
+        if choices:
+            out[int(item["custom_id"])] = choices[0]["message"].get("content") or ""
+    return out
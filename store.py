@@ -1,55 +1,161 @@
 # store.py — хранилище состояний счётов (в памяти, MVP)
+# INVOICE_STORE_PATH задан — счета живут в LMDB (msgpack) и переживают перезапуск бота.
 from __future__ import annotations
+import logging
+import os
+from dataclasses import dataclass
+from enum import IntEnum
 
-WAIT     = "WAIT"      # Ожидает согласования
-APPROVED = "APPROVED"  # Согласован (ждём оплату/QR)
-REJECTED = "REJECTED"  # Отклонён (можно указать причину)
-PAID     = "PAID"      # Оплачен (ждём получение)
-RECEIVED = "RECEIVED"  # Получен/Забран (финал)
+log = logging.getLogger("store")
+
+STORE_PATH = os.getenv("INVOICE_STORE_PATH", "")  # пусто — только память
+STORE_MAP_SIZE = int(os.getenv("INVOICE_STORE_MAP_SIZE", str(1 << 30)))
+
+class Status(IntEnum):
+    WAIT     = 0  # Ожидает согласования
+    APPROVED = 1  # Согласован (ждём оплату/QR)
+    REJECTED = 2  # Отклонён (можно указать причину)
+    PAID     = 3  # Оплачен (ждём получение)
+    RECEIVED = 4  # Получен/Забран (финал)
+
+# прежние имена: from store import WAIT, APPROVED, ... продолжает работать
+WAIT     = Status.WAIT
+APPROVED = Status.APPROVED
+REJECTED = Status.REJECTED
+PAID     = Status.PAID
+RECEIVED = Status.RECEIVED
+
+# slots=True — Python 3.10+ (минимальная версия указана в README/requirements.txt)
+@dataclass(slots=True)
+class Source:
+    """Исходное сообщение с файлом счёта."""
+    chat_id: int
+    thread_id: int | None
+    user_msg_id: int
+    file_id: str
+    file_type: str  # "document" | "photo" | "excel"
+
+@dataclass(slots=True)
+class Invoice:
+    # __slots__ вместо словаря на каждый счёт: в разы меньше памяти на запись
+    status: Status = WAIT
+    reason: str = ""
+    kind: str = "unknown"
+    src: Source | None = None
+    batch: str | None = None  # id батча OpenAI, пока счёт в пакетной обработке (processor_batch)
 
 class InvoiceStore:
-    def __init__(self) -> None:
+    def __init__(self, path: str = "") -> None:
         # ключ — message_id статусного сообщения бота (на котором кнопки)
-        # значение — словарь: {status, reason, kind, src}
-        # src: {chat_id, thread_id, user_msg_id, file_id, file_type}
-        self.invoices: dict[int, dict] = {}
+        self.invoices: dict[int, Invoice] = {}
+        self._env = None
+        self._msgpack = None
+        if path:
+            try:
+                import lmdb
+                import msgpack
+                self._env = lmdb.open(path, map_size=STORE_MAP_SIZE)
+                self._msgpack = msgpack
+            except Exception as e:
+                log.warning("LMDB store unavailable, keeping invoices in memory: %s", e)
+
+    # --- LMDB: запись — msgpack-массив [status, reason, kind, src, batch] ---
+    @staticmethod
+    def _key(status_msg_id: int) -> bytes:
+        return status_msg_id.to_bytes(8, "big", signed=True)
+
+    def _pack(self, inv: Invoice) -> bytes:
+        src = inv.src
+        src_row = [src.chat_id, src.thread_id, src.user_msg_id, src.file_id, src.file_type] if src else None
+        return self._msgpack.packb([int(inv.status), inv.reason, inv.kind, src_row, inv.batch])
+
+    def _unpack(self, raw: bytes) -> Invoice:
+        status, reason, kind, src_row, batch = self._msgpack.unpackb(raw)
+        return Invoice(Status(status), reason, kind, Source(*src_row) if src_row else None, batch)
 
     def create(self, status_msg_id: int, kind: str = "unknown") -> None:
-        self.invoices[status_msg_id] = {
-            "status": WAIT,
-            "reason": "",
-            "kind": kind,
-            "src": None,
-        }
+        inv = Invoice(kind=kind)
+        if self._env is None:
+            self.invoices[status_msg_id] = inv
+            return
+        with self._env.begin(write=True) as txn:
+            txn.put(self._key(status_msg_id), self._pack(inv))
+
+    def _ensure(self, status_msg_id: int, status: Status = WAIT) -> Invoice:
+        # не setdefault(..., Invoice()): запись-заглушка создавалась бы на каждый вызов
+        inv = self.invoices.get(status_msg_id)
+        if inv is None:
+            inv = self.invoices[status_msg_id] = Invoice(status=status)
+        return inv
+
+    def _set(self, status_msg_id: int, field: str, value, status: Status = WAIT) -> None:
+        """Одно поле записи; в LMDB — чтение и запись в одной транзакции."""
+        if self._env is None:
+            setattr(self._ensure(status_msg_id, status), field, value)
+            return
+        key = self._key(status_msg_id)
+        with self._env.begin(write=True) as txn:
+            raw = txn.get(key)
+            inv = self._unpack(raw) if raw is not None else Invoice(status=status)
+            setattr(inv, field, value)
+            txn.put(key, self._pack(inv))
 
-    def set_status(self, status_msg_id: int, status: str) -> None:
-        inv = self.invoices.setdefault(status_msg_id, {"status": WAIT, "reason": "", "kind": "unknown", "src": None})
-        inv["status"] = status
+    def set_status(self, status_msg_id: int, status: Status) -> None:
+        self._set(status_msg_id, "status", status)
 
     def set_reason(self, status_msg_id: int, reason: str) -> None:
-        inv = self.invoices.setdefault(status_msg_id, {"status": REJECTED, "reason": "", "kind": "unknown", "src": None})
-        inv["reason"] = (reason or "").strip()
+        self._set(status_msg_id, "reason", (reason or "").strip(), status=REJECTED)
 
     def set_kind(self, status_msg_id: int, kind: str) -> None:
-        inv = self.invoices.setdefault(status_msg_id, {"status": WAIT, "reason": "", "kind": "unknown", "src": None})
-        inv["kind"] = kind
+        self._set(status_msg_id, "kind", kind)
 
     def set_source(self, status_msg_id: int, *, chat_id: int, thread_id: int | None, user_msg_id: int, file_id: str, file_type: str) -> None:
-        inv = self.invoices.setdefault(status_msg_id, {"status": WAIT, "reason": "", "kind": "unknown", "src": None})
-        inv["src"] = {
-            "chat_id": chat_id,
-            "thread_id": thread_id,
-            "user_msg_id": user_msg_id,
-            "file_id": file_id,
-            "file_type": file_type,
-        }
+        self._set(status_msg_id, "src", Source(
+            chat_id=chat_id,
+            thread_id=thread_id,
+            user_msg_id=user_msg_id,
+            file_id=file_id,
+            file_type=file_type,
+        ))
+
+    def set_batch(self, status_msg_id: int, batch_id: str | None) -> None:
+        self._set(status_msg_id, "batch", batch_id)
+
+    def items(self) -> list[tuple[int, Invoice]]:
+        """Снимок всех записей: [(status_msg_id, Invoice)]."""
+        if self._env is None:
+            return list(self.invoices.items())
+        with self._env.begin() as txn:
+            return [
+                (int.from_bytes(key, "big", signed=True), self._unpack(raw))
+                for key, raw in txn.cursor()
+            ]
+
+    def get(self, status_msg_id: int) -> Invoice | None:
+        """Запись счёта или None. В LMDB-режиме — отвязанная копия: правки объекта
+        в хранилище не попадают, менять только через set_*."""
+        if self._env is None:
+            return self.invoices.get(status_msg_id)
+        with self._env.begin(buffers=True) as txn:
+            raw = txn.get(self._key(status_msg_id))  # memoryview на страницу mmap, без копии
+            return self._unpack(raw) if raw is not None else None
 
-    def get(self, status_msg_id: int) -> dict | None:
-        return self.invoices.get(status_msg_id)
+store = InvoiceStore(STORE_PATH)
 
-store = InvoiceStore()
+# строковые статусы старых вызовов (в верхнем регистре), означающие «ждёт согласования»
+_WAIT_ALIASES = frozenset(("WAIT", "PENDING"))
 
 # совместимость: создаёт запись и проставляет статус/тип
-def store_invoice(status_msg_id: int, status: str = "WAIT", kind: str = "unknown") -> None:
+def store_invoice(status_msg_id: int, status: Status | str = "WAIT", kind: str = "unknown") -> None:
+    # старые вызовы передают строку ("pending", "WAIT", "paid"...) — приводим к Status
+    # до создания записи, чтобы неизвестный статус не оставлял её полусозданной
+    if isinstance(status, str):
+        name = status.strip().upper()
+        if name in _WAIT_ALIASES:
+            status = WAIT
+        elif name in Status.__members__:
+            status = Status[name]
+        else:
+            raise ValueError(f"Unknown invoice status: {status!r}")
     store.create(status_msg_id, kind=kind)
-    store.set_status(status_msg_id, WAIT if status in ("WAIT", "pending") else status)
+    store.set_status(status_msg_id, status)
@@ -0,0 +1,51 @@
+# tests/test_gpt_batcher.py — микробатчер: общий запрос и откат на одиночные
+import asyncio
+import json
+
+import processor
+from processor import GptBatcher
+
+ACC_A = "40702810938000012345"
+ACC_B = "40702810938000010004"
+
+
+def _content(acc: str) -> list:
+    return [{"type": "text", "text": "Счёт"}, {"type": "text", "text": f"р/с {acc}"}]
+
+
+def _run(monkeypatch, multi_reply: str):
+    calls = []
+
+    async def fake(body):
+        texts = [p.get("text", "") for p in body["messages"][-1]["content"]]
+        if any("разных счетов" in t for t in texts):
+            calls.append("multi")
+            return multi_reply
+        calls.append("single")
+        acc = next(t for t in texts if t.startswith("р/с")).split()[-1]
+        return json.dumps({"fields": {"PersonalAcc": acc}})
+
+    monkeypatch.setattr(processor, "_chat_completion", fake)
+
+    async def main():
+        b = GptBatcher("m", max_batch=2, window=0.05)
+        return await asyncio.gather(b.submit(_content(ACC_A)), b.submit(_content(ACC_B)))
+
+    replies = asyncio.run(main())
+    return [json.loads(r)["fields"]["PersonalAcc"] for r in replies], calls
+
+
+def test_batcher_bad_combined_json_falls_back_to_single(monkeypatch):
+    accs, calls = _run(monkeypatch, "not json")
+    assert accs == [ACC_A, ACC_B]
+    assert calls.count("single") == 2
+
+
+def test_batcher_rejects_swapped_results(monkeypatch):
+    swapped = json.dumps({"results": [
+        {"id": 0, "fields": {"PersonalAcc": ACC_B}},
+        {"id": 1, "fields": {"PersonalAcc": ACC_B}},
+    ]})
+    accs, calls = _run(monkeypatch, swapped)
+    assert accs == [ACC_A, ACC_B]
+    assert calls == ["multi", "single"]
@@ -0,0 +1,110 @@
+# tests/test_local_extract.py — разбор реквизитов без GPT: отсюда QR уходит на оплату напрямую
+import pytest
+
+from processor import _acc_key_ok, _extract_locally, _payable_total, _pre_hint
+
+BIC = "044525225"
+CORRESP = "30101810400000000225"   # реальный к/с ПАО Сбербанк для этого БИК
+PERSONAL = "40702810938000012345"  # р/с с верным контрольным ключом
+OTHER_ACC = "40702810938000010004" # другой р/с в том же банке, ключ тоже верный
+
+
+def _invoice(totals: str, vat: str = "Без НДС") -> str:
+    return (
+        "Счёт на оплату № 125 от 01.02.2024\n"
+        "Поставщик: ООО Ромашка, ИНН 7701234567, КПП 770101001\n"
+        "ПАО Сбербанк г. Москва\n"
+        f"БИК {BIC}\n"
+        f"Сч. № {CORRESP}\n"
+        f"Сч. № {PERSONAL}\n"
+        "Товар 1 шт.\n"
+        f"{totals}\n"
+        f"{vat}\n"
+    )
+
+
+def _local(text: str):
+    return _extract_locally(text, _pre_hint(text))
+
+
+# -------- контрольный ключ счёта --------
+def test_acc_key_ok_accepts_valid_accounts():
+    assert _acc_key_ok(BIC, CORRESP, corresp=True)
+    assert _acc_key_ok(BIC, PERSONAL)
+
+
+@pytest.mark.parametrize("acc", ["40702810038000012345", "40702810938000012346"])
+def test_acc_key_ok_rejects_wrong_key(acc):
+    assert not _acc_key_ok(BIC, acc)
+
+
+def test_acc_key_ok_corresp_uses_bic_digits():
+    # к/с проверяется по «0» + 5-6 цифрам БИК, а не по последним трём
+    assert not _acc_key_ok(BIC, CORRESP)
+    assert not _acc_key_ok("044535225", CORRESP, corresp=True)
+
+
+# -------- сумма к оплате --------
+def test_local_extract_uses_payable_amount():
+    res = _local(_invoice("Итого: 10 000,00\nВсего к оплате: 10 000,00"))
+    assert res is not None
+    st, fields = res
+    assert fields["Sum"] == "1000000"
+    assert f"PersonalAcc={PERSONAL}" in st
+
+
+def test_local_extract_discount_goes_to_gpt():
+    # «Итого» до скидки не должно стать суммой платежа
+    text = _invoice("Итого: 12 000,00\nСкидка: 2 000,00\nВсего к оплате: 10 000,00")
+    assert _local(text) is None
+
+
+def test_local_extract_without_payable_goes_to_gpt():
+    assert _local(_invoice("Итого: 10 000,00")) is None
+
+
+def test_local_extract_rejects_bad_account_key():
+    text = _invoice("Всего к оплате: 10 000,00").replace(PERSONAL, "40702810038000012345")
+    assert _local(text) is None
+
+
+# -------- реквизиты только из блока получателя --------
+def test_local_extract_ignores_buyer_inn_kpp():
+    text = _invoice("Всего к оплате: 10 000,00").replace(
+        "Поставщик:", "Покупатель: ООО Лютик, ИНН 5009876543, КПП 500901001\nПоставщик:"
+    )
+    res = _local(text)
+    assert res is not None
+    fields = res[1]
+    assert fields["PayeeINN"] == "7701234567"
+    assert fields["KPP"] == "770101001"
+
+
+def test_local_extract_ignores_payer_account():
+    text = _invoice("Всего к оплате: 10 000,00").replace(
+        "Поставщик:", f"Плательщик: ООО Лютик, р/с {OTHER_ACC}\nПоставщик:"
+    )
+    res = _local(text)
+    assert res is not None
+    assert res[1]["PersonalAcc"] == PERSONAL
+
+
+def test_local_extract_two_payee_accounts_go_to_gpt():
+    text = _invoice("Всего к оплате: 10 000,00").replace(
+        f"Сч. № {PERSONAL}\n", f"Сч. № {PERSONAL}\nСч. № {OTHER_ACC}\n"
+    )
+    assert _local(text) is None
+
+
+def test_local_extract_two_inns_go_to_gpt():
+    text = _invoice("Всего к оплате: 10 000,00").replace("КПП 770101001", "КПП 770101001, ИНН 5009876543")
+    assert _local(text) is None
+
+
+def test_payable_total_ignores_subtotal_substring():
+    assert _payable_total("Subtotal: 5,00\nК оплате: 7,00") == 7.0
+
+
+def test_payable_total_conflicting_amounts():
+    assert _payable_total("К оплате: 7,00\nВсего к оплате: 8,00") is None
+    assert _payable_total("Total: 9,00\nК оплате: 7,00") is None
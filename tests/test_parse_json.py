@@ -0,0 +1,19 @@
+# tests/test_parse_json.py — разбор ответа модели
+import pytest
+
+from processor import _parse_json, _result_from_reply
+
+
+def test_parse_json_plain_object():
+    assert _parse_json('{"st": "ST00012|Name=A"}') == {"st": "ST00012|Name=A"}
+
+
+def test_parse_json_object_inside_array():
+    assert _parse_json('[{"notes": "x"}]') == {"notes": "x"}
+
+
+@pytest.mark.parametrize("raw", ['"x"', "[1, 2]", "42", "null"])
+def test_result_from_reply_non_object(raw):
+    st, fields, notes = _result_from_reply(raw)
+    assert st is None and fields is None
+    assert notes.startswith("Bad JSON from GPT")
@@ -0,0 +1,18 @@
+# tests/test_store.py — приведение строковых статусов в store_invoice
+import pytest
+
+from store import APPROVED, PAID, WAIT, store, store_invoice
+
+
+@pytest.mark.parametrize("status, expected", [
+    ("pending", WAIT), ("WAIT", WAIT), ("paid", PAID), ("Approved", APPROVED), (PAID, PAID),
+])
+def test_store_invoice_normalises_status(status, expected):
+    store_invoice(101, status=status)
+    assert store.get(101).status is expected
+
+
+def test_store_invoice_unknown_status_creates_nothing():
+    with pytest.raises(ValueError):
+        store_invoice(102, status="NEW")
+    assert store.get(102) is None
@@ -0,0 +1,33 @@
+# tests/test_store_lmdb.py — LMDB-режим InvoiceStore: запись переживает переоткрытие
+import pytest
+
+pytest.importorskip("lmdb")
+pytest.importorskip("msgpack")
+
+from store import APPROVED, REJECTED, Invoice, InvoiceStore, Source
+
+
+def test_lmdb_round_trip(tmp_path):
+    s = InvoiceStore(str(tmp_path))
+    assert s._env is not None
+    s.create(10, kind="pdf")
+    s.set_status(10, APPROVED)
+    s.set_kind(10, "photo")
+    s.set_source(10, chat_id=-100, thread_id=7, user_msg_id=9, file_id="AgAD", file_type="photo")
+    s.set_batch(10, "batch_1")
+    s.set_reason(11, " дорого ")   # записи ещё нет — создаётся со статусом REJECTED
+    s._env.close()
+
+    s = InvoiceStore(str(tmp_path))
+    src = Source(chat_id=-100, thread_id=7, user_msg_id=9, file_id="AgAD", file_type="photo")
+    inv = s.get(10)
+    assert inv == Invoice(status=APPROVED, reason="", kind="photo", src=src, batch="batch_1")
+    assert s.get(11) == Invoice(status=REJECTED, reason="дорого")
+    assert s.get(12) is None
+    assert dict(s.items()) == {10: inv, 11: s.get(11)}
+
+    # get отдаёт копию: правка объекта не меняет запись
+    inv.status = REJECTED
+    assert s.get(10).status == APPROVED
+    s.set_batch(10, None)
+    assert s.get(10).batch is None